@@ -0,0 +1,99 @@
+import asyncio
+import functools
+import logging
+import time
+import httpx
+import orjson
+
+API_BASE_URL = 'https://api.celenium.io/v1'
+RATE_LIMIT = 3  # Celenium allows 3 calls per second
+MAX_CONNECTIONS = 8  # Over HTTP/2 each connection multiplexes many in-flight requests
+REQUEST_TIMEOUT = 10
+KEEPALIVE_TIMEOUT = 60  # Keep idle connections open so TLS handshakes are amortized across calls
+RETRY_DELAYS = (1, 2, 4, 8, 16)  # Exponential back-off between attempts, in seconds
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRY_AFTER = 60  # Upper bound on a server-requested wait, in seconds
+API_ERRORS = (httpx.HTTPError, orjson.JSONDecodeError)  # Non-JSON bodies, e.g. a maintenance page, are retried too
+
+# httpx logs every request at INFO; keep only its warnings
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+class RateLimiter:
+    """Token bucket refilled at `rate` tokens per second."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return self
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    def defer(self, seconds):
+        # Hand out no tokens for the next `seconds`, e.g. after a 429
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+# One token at most, so calls stay evenly spaced and never burst past RATE_LIMIT after an idle period
+limiter = RateLimiter(RATE_LIMIT, capacity=1)
+
+def get_retry_after(error):
+    # Seconds a 429 response asked us to wait, or None
+    if not isinstance(error, httpx.HTTPStatusError) or error.response.status_code != 429:
+        return None
+    try:
+        return min(float(error.response.headers['Retry-After']), MAX_RETRY_AFTER)
+    except (KeyError, ValueError):  # Missing header or an HTTP-date, which we don't parse
+        return None
+
+def retry(delays=RETRY_DELAYS):
+    # HTTP errors are retried only for RETRY_STATUSES; a 429's Retry-After overrides the delay
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for delay in delays:
+                try:
+                    return await func(*args, **kwargs)
+                except API_ERRORS as e:
+                    if isinstance(e, httpx.HTTPStatusError) and e.response.status_code not in RETRY_STATUSES:
+                        raise
+                    retry_after = get_retry_after(e)
+                    if retry_after is not None:
+                        delay = retry_after
+                        limiter.defer(delay)
+                    logging.error("Error in %s%s: %r. Retrying in %ss", func.__name__, args[1:], e, delay)
+                    await asyncio.sleep(delay)
+            return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def create_client():
+    # httpx falls back to HTTP/1.1 if the server doesn't negotiate h2
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_TIMEOUT
+    )
+    # No pool timeout: requests queued behind the rate limiter may wait longer than REQUEST_TIMEOUT for a slot
+    timeout = httpx.Timeout(REQUEST_TIMEOUT, pool=None)
+    return httpx.AsyncClient(base_url=API_BASE_URL, http2=True, limits=limits, timeout=timeout)
+
+@retry()
+async def get_json(client, path, params=None):
+    async with limiter:
+        response = await client.get(path, params=params)
+    response.raise_for_status()
+    return orjson.loads(response.content)
@@ -1,11 +1,16 @@
+import argparse
+import asyncio
 import csv
-import time
+import itertools
 import logging
 import json
 import os
-import requests
-from requests.exceptions import RequestException
-from time import sleep
+import re
+import sqlite3
+from contextlib import ExitStack, aclosing
+from decimal import Decimal, InvalidOperation
+import orjson
+from celenium_api import create_client, get_json
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -13,158 +18,359 @@ INPUT_FILE = 'data/vested_addresses.csv'
 TRANSACTIONS_OUTPUT_FILE = 'data/withdrawal_transactions.csv'
 SUMMARY_OUTPUT_FILE = 'data/withdrawal_summary.csv'
 CHECKPOINT_FILE = 'withdrawal_checkpoint.json'
+EVENTS_CACHE_FILE = 'events_cache.db'
+EVENTS_CACHE_COMMIT_INTERVAL = 100  # New cache entries between commits
 BATCH_SIZE = 100
-RATE_LIMIT_DELAY = 1/3  # 1/3 second delay to respect 3 calls per second limit
+ADDRESS_CONCURRENCY = 8  # Addresses processed at the same time; they share the API rate limit
+CHECKPOINT_INTERVAL = 50  # Rows processed between checkpoint writes
+OUTPUT_BUFFER_SIZE = 1 << 20  # 1 MiB write buffer per output file
+TRANSACTION_FIELDNAMES = ['id', 'height', 'position', 'gas_wanted', 'gas_used', 'timeout_height', 'events_count',
+                          'messages_count', 'hash', 'fee', 'time', 'message_types', 'status', 'withdraw_amount', 'address']
+# Fields whose values may contain commas; the fast writer always quotes them
+QUOTED_TRANSACTION_FIELDS = ('fee', 'message_types')
+_TRANSACTION_ROW_FORMAT = ','.join(
+    '"{}"' if field in QUOTED_TRANSACTION_FIELDS else '{}' for field in TRANSACTION_FIELDNAMES
+) + '\r\n'  # Same line terminator as csv.writer, so both paths can append to one file
+SUMMARY_FIELDNAMES = ['address', 'withdraw_count', 'sum_withdrawn_amount']
+_UTIA_AMOUNT_RE = re.compile(r'^(\d+)utia$')
 
 def load_checkpoint():
     logging.info("Loading checkpoint")
     if os.path.exists(CHECKPOINT_FILE):
         with open(CHECKPOINT_FILE, 'r') as f:
             checkpoint = json.load(f)
-            logging.info(f"Checkpoint loaded. Last processed row: {checkpoint['last_processed_row']}")
+            logging.info("Checkpoint loaded. Last processed row: %s", checkpoint['last_processed_row'])
             return checkpoint
     logging.info("No checkpoint found. Starting from the beginning.")
     return {'last_processed_row': -1}
 
 def save_checkpoint(last_processed_row):
-    logging.info(f"Saving checkpoint. Last processed row: {last_processed_row}")
+    logging.info("Saving checkpoint. Last processed row: %s", last_processed_row)
     with open(CHECKPOINT_FILE, 'w') as f:
         json.dump({'last_processed_row': last_processed_row}, f)
 
-def get_transactions(address, offset=0):
-    logging.info(f"Fetching transactions for address {address}, offset {offset}")
-    while True:
-        try:
-            response = requests.get(
-                f"https://api.celenium.io/v1/address/{address}/txs",
-                params={
-                    'limit': BATCH_SIZE,
-                    'offset': offset,
-                    'msg_type': 'MsgWithdrawDelegatorReward'
-                },
-                timeout=10
-            )
-            response.raise_for_status()
-            transactions = response.json()
-            logging.info(f"Fetched {len(transactions)} transactions for address {address}")
-            time.sleep(0.33)  # Respect rate limit
-            return transactions
-        except RequestException as e:
-            logging.error(f"Error fetching transactions for address {address}: {e}")
-            time.sleep(5)  # Wait before retrying
-
-def get_transaction_events(tx_hash):
-    while True:
-        try:
-            response = requests.get(
-                f"https://api.celenium.io/v1/tx/{tx_hash}/events",
-                params={'limit': 100},  # Assuming max 100 events per transaction
-                timeout=10
-            )
-            response.raise_for_status()
-            events = response.json()
-            time.sleep(0.33)  # Respect rate limit
-            return events
-        except RequestException as e:
-            logging.error(f"Error fetching events for transaction {tx_hash}: {e}")
-            time.sleep(5)  # Wait before retrying
-
-def process_address(row_number, address):
-    logging.info(f"Processing row {row_number}, address: {address}")
-    all_transactions = []
+class EventCache:
+    # Events of an on-chain transaction never change, so they are cached by hash across runs
+
+    def __init__(self, path=EVENTS_CACHE_FILE):
+        self.path = path
+        self.pending = 0
+
+    def __enter__(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS ev (hash TEXT PRIMARY KEY, payload BLOB)")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.commit()
+        self.db.close()
+        return False
+
+    def get(self, tx_hash):
+        row = self.db.execute("SELECT payload FROM ev WHERE hash = ?", (tx_hash,)).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def put(self, tx_hash, events):
+        self.db.execute("INSERT OR REPLACE INTO ev (hash, payload) VALUES (?, ?)", (tx_hash, orjson.dumps(events)))
+        self.pending += 1
+        if self.pending >= EVENTS_CACHE_COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending = 0
+
+async def get_transactions(client, address, offset=0):
+    logging.info("Fetching transactions for address %s, offset %s", address, offset)
+    transactions = await get_json(
+        client,
+        f"/address/{address}/txs",
+        params={
+            'limit': BATCH_SIZE,
+            'offset': offset,
+            'msg_type': 'MsgWithdrawDelegatorReward'
+        }
+    )
+    logging.info("Fetched %s transactions for address %s", len(transactions), address)
+    return transactions
+
+async def get_transaction_events(client, cache, tx_hash):
+    events = cache.get(tx_hash)
+    if events is not None:
+        return events
+    events = await get_json(
+        client,
+        f"/tx/{tx_hash}/events",
+        params={'limit': 100}  # Assuming max 100 events per transaction
+    )
+    cache.put(tx_hash, events)
+    return events
+
+async def get_withdraw_events(client, cache, tx, always_fetch_events=False):
+    # Skip the events call when the transaction has no events or a single inline utia amount
+    if not always_fetch_events:
+        if tx.get('events_count') == 0:
+            return []
+        amount = (tx.get('data') or {}).get('amount')
+        if tx.get('messages_count') == 1 and isinstance(amount, str) and _UTIA_AMOUNT_RE.match(amount):
+            return [{'type': 'withdraw_rewards', 'data': {'amount': amount}}]
+    return await get_transaction_events(client, cache, tx['hash'])
+
+async def fetch_transaction_page(client, cache, address, offset, always_fetch_events=False):
+    # Returns the page and a future of its events, one list per transaction
+    transactions = await get_transactions(client, address, offset)
+    # The shared rate limiter, not this fan-out, paces the calls
+    lookups = [asyncio.ensure_future(get_withdraw_events(client, cache, tx, always_fetch_events)) for tx in transactions]
+    events = asyncio.gather(*lookups)
+
+    def stop_lookups(f):
+        # gather leaves the other lookups running when one fails; retrieving the outcome also keeps asyncio quiet
+        if f.cancelled() or f.exception() is not None:
+            for lookup in lookups:
+                lookup.cancel()
+
+    events.add_done_callback(stop_lookups)
+    return transactions, events
+
+async def iter_transaction_pages(client, cache, address, always_fetch_events=False):
+    # The next page and its event lookups start before the caller is done with the current page
     offset = 0
+    next_page = asyncio.create_task(fetch_transaction_page(client, cache, address, offset, always_fetch_events))
+    try:
+        while True:
+            transactions, events = await next_page
+            if not transactions:
+                logging.info("No more transactions for address %s", address)
+                return
+
+            offset += len(transactions)
+            if len(transactions) < BATCH_SIZE:
+                logging.info("Reached end of transactions for address %s", address)
+                yield transactions, events
+                return
+
+            next_page = asyncio.create_task(fetch_transaction_page(client, cache, address, offset, always_fetch_events))
+            yield transactions, events
+    finally:
+        # Stop lookups that are still in flight if the caller gave up early
+        next_page.cancel()
+        if next_page.done() and not next_page.cancelled() and next_page.exception() is None:
+            next_page.result()[1].cancel()
+
+async def process_address(client, cache, writers, row_number, address, always_fetch_events=False):
+    logging.info("Processing row %s, address: %s", row_number, address)
     total_withdrawn = 0
     withdraw_count = 0
 
-    while True:
-        transactions = get_transactions(address, offset)
-        if not transactions:
-            logging.info(f"No more transactions for address {address}")
-            break
+    # Closed on the way out, so the prefetched page's lookups stop when this address fails
+    async with aclosing(iter_transaction_pages(client, cache, address, always_fetch_events)) as pages:
+        async for transactions, events in pages:
+            events_per_tx = await events
+            for tx, tx_events in zip(transactions, events_per_tx):
+                withdraw_amount = 0
+                for event in tx_events:
+                    if event['type'] != 'withdraw_rewards':
+                        continue
+                    match = _UTIA_AMOUNT_RE.match(event['data'].get('amount', ''))
+                    if match:
+                        withdraw_amount += int(match.group(1))
+                tx['withdraw_amount'] = withdraw_amount
+                tx['address'] = address  # Add address to transaction data
+                total_withdrawn += withdraw_amount
+                withdraw_count += 1
+                logging.debug("Processed transaction %s for address %s. Withdraw amount: %d", tx['hash'], address, withdraw_amount)
 
-        for tx in transactions:
-            events = get_transaction_events(tx['hash'])
-            withdraw_amount = sum(
-                int(event['data'].get('amount', '0').rstrip('utia'))
-                for event in events
-                if event['type'] == 'withdraw_rewards' and event['data'].get('amount', '').endswith('utia')
-            )
-            tx['withdraw_amount'] = withdraw_amount
-            tx['address'] = address  # Add address to transaction data
-            all_transactions.append(tx)
-            total_withdrawn += withdraw_amount
-            withdraw_count += 1
-            logging.info(f"Processed transaction {tx['hash']} for address {address}. Withdraw amount: {withdraw_amount}")
-
-        offset += len(transactions)
-        if len(transactions) < BATCH_SIZE:
-            logging.info(f"Reached end of transactions for address {address}")
-            break
-
-    logging.info(f"Completed processing row {row_number}, address {address}. Total withdrawals: {withdraw_count}, Total amount: {total_withdrawn}")
-    return row_number, address, all_transactions, withdraw_count, total_withdrawn
-
-def write_transactions_to_csv(transactions):
-    if not transactions:
-        logging.info("No transactions to write")
+            # Written page by page; a resume skips rows already written for an address without a summary
+            writers.write_transactions(transactions)
+
+    logging.info("Completed processing row %s, address %s. Total withdrawals: %s, Total amount: %s", row_number, address, withdraw_count, total_withdrawn)
+    return row_number, address, withdraw_count, total_withdrawn
+
+def format_transaction_row(tx):
+    # Only QUOTED_TRANSACTION_FIELDS can contain commas or quotes; the rest are written as is
+    values = []
+    for field in TRANSACTION_FIELDNAMES:
+        value = tx.get(field)
+        if value is None:
+            value = ''
+        elif field in QUOTED_TRANSACTION_FIELDS:
+            value = str(value).replace('"', '""')
+        values.append(value)
+    return _TRANSACTION_ROW_FORMAT.format(*values)
+
+def truncate_partial_line(path):
+    # Drop a trailing row cut short by a hard kill
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - OUTPUT_BUFFER_SIZE)
+            f.seek(start)
+            chunk = f.read(position - start)
+            newline = chunk.rfind(b'\n')
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position != end:
+            logging.info("Truncating partial row at the end of %s", path)
+            f.truncate(position)
+
+def read_rows(path):
+    if not os.path.exists(path):
         return
+    with open(path, 'r', newline='') as f:
+        yield from csv.DictReader(f)
 
-    logging.info(f"Writing {len(transactions)} transactions to CSV")
-    mode = 'a' if os.path.exists(TRANSACTIONS_OUTPUT_FILE) else 'w'
-    fieldnames = ['id', 'height', 'position', 'gas_wanted', 'gas_used', 'timeout_height', 'events_count', 
-                  'messages_count', 'hash', 'fee', 'time', 'message_types', 'status', 'withdraw_amount', 'address']
-    
-    with open(TRANSACTIONS_OUTPUT_FILE, mode, newline='') as csvfile:
+class CsvWriterContext:
+    # Output files stay open for the whole run; `safe` writes transactions through csv.writer
+
+    def __init__(self, safe=False):
+        self.safe = safe
+        self.stack = ExitStack()
+
+    def __enter__(self):
+        self._load_written()
+        self.tx_file, _ = self._open(TRANSACTIONS_OUTPUT_FILE, TRANSACTION_FIELDNAMES)
+        # Positional writer: rows are projected onto TRANSACTION_FIELDNAMES once, not once more inside DictWriter
+        self.tx_writer = csv.writer(self.tx_file)
+        self.summary_file, self.summary_writer = self._open(SUMMARY_OUTPUT_FILE, SUMMARY_FIELDNAMES)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self.stack.__exit__(exc_type, exc, tb)
+
+    def _load_written(self):
+        truncate_partial_line(TRANSACTIONS_OUTPUT_FILE)
+        truncate_partial_line(SUMMARY_OUTPUT_FILE)
+        # A summary row marks an address done; hashes already written for other addresses are skipped
+        self.completed = {row['address'] for row in read_rows(SUMMARY_OUTPUT_FILE)}
+        self.written = {}
+        for row in read_rows(TRANSACTIONS_OUTPUT_FILE):
+            if row['address'] not in self.completed:
+                self.written.setdefault(row['address'], set()).add(row['hash'])
+        if self.completed or self.written:
+            logging.info("Found %s completed and %s partially written addresses", len(self.completed), len(self.written))
+
+    def _open(self, path, fieldnames):
+        csvfile = self.stack.enter_context(open(path, 'a', newline='', buffering=OUTPUT_BUFFER_SIZE))
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        if csvfile.tell() == 0:
+        if os.path.getsize(path) == 0:
             writer.writeheader()
+            logging.info("Created new CSV file %s and wrote header", path)
+        return csvfile, writer
+
+    def write_transactions(self, transactions):
         for tx in transactions:
             tx['hash'] = tx['hash'].upper()
-            # Create a new dict with only the specified fields
-            filtered_tx = {field: tx.get(field, '') for field in fieldnames}
-            writer.writerow(filtered_tx)
-
-def write_summary_to_csv(summary):
-    logging.info(f"Writing summary for address {summary['address']} to CSV")
-    mode = 'a' if os.path.exists(SUMMARY_OUTPUT_FILE) else 'w'
-    with open(SUMMARY_OUTPUT_FILE, mode, newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=['address', 'withdraw_count', 'sum_withdrawn_amount'])
-        if csvfile.tell() == 0:
-            writer.writeheader()
-        writer.writerow(summary)
-    logging.info("Finished writing summary to CSV")
+        if self.written:
+            transactions = [tx for tx in transactions if tx['hash'] not in self.written.get(tx['address'], ())]
+        if not transactions:
+            logging.info("No transactions to write")
+            return
+
+        logging.debug("Writing %d transactions to CSV", len(transactions))
+        # One call per page rather than one per row
+        if self.safe:
+            self.tx_writer.writerows([[tx.get(field, '') for field in TRANSACTION_FIELDNAMES] for tx in transactions])
+        else:
+            self.tx_file.write(''.join([format_transaction_row(tx) for tx in transactions]))
+
+    def write_summary(self, summary):
+        logging.debug("Writing summary for address %s to CSV", summary['address'])
+        # The transactions must reach the file before the row that marks the address completed
+        self.tx_file.flush()
+        self.summary_writer.writerow(summary)
+        self.completed.add(summary['address'])
+        self.written.pop(summary['address'], None)
+
+    def flush(self):
+        # Rows must be on disk before a checkpoint records them
+        self.tx_file.flush()
+        self.summary_file.flush()
 
-def process_all_addresses():
+def has_vesting(row):
+    # Rows with a missing or unparsable amount are kept
+    try:
+        return Decimal(row.get('amount') or 'NaN') != 0
+    except InvalidOperation:
+        return True
+
+class RowProgress:
+    # Highest row up to which every row is done, while rows finish out of order
+
+    def __init__(self, last_processed_row):
+        self.last_processed_row = last_processed_row
+        self.saved_row = last_processed_row
+        self.finished = set()
+
+    def complete(self, row_number):
+        self.finished.add(row_number)
+        while self.last_processed_row + 1 in self.finished:
+            self.last_processed_row += 1
+            self.finished.remove(self.last_processed_row)
+
+async def process_all_addresses(safe=False, always_fetch_events=False):
     checkpoint = load_checkpoint()
-    last_processed_row = checkpoint['last_processed_row']
-
-    logging.info("Reading addresses from input file")
-    with open(INPUT_FILE, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        addresses = list(reader)
-    logging.info(f"Found {len(addresses)} addresses in total")
-
-    for i, address_data in enumerate(addresses):
-        if i <= last_processed_row:
-            continue
-        
-        row_number, address, transactions, withdraw_count, total_withdrawn = process_address(i, address_data['address'])
-        
-        if transactions:
-            write_transactions_to_csv(transactions)
-        
-        write_summary_to_csv({
-            'address': address,
-            'withdraw_count': withdraw_count,
-            'sum_withdrawn_amount': total_withdrawn
-        })
-        
-        save_checkpoint(row_number)
-        logging.info(f"Completed processing row {row_number}, address: {address}, Withdrawals: {withdraw_count}, Total amount: {total_withdrawn}")
-        
-        sleep(RATE_LIMIT_DELAY)  # Respect rate limit between address processing
+    progress = RowProgress(checkpoint['last_processed_row'])
+    semaphore = asyncio.Semaphore(ADDRESS_CONCURRENCY)
+
+    try:
+        async with create_client() as client:
+            with open(INPUT_FILE, 'r') as csvfile, EventCache() as cache, CsvWriterContext(safe=safe) as writers:
+
+                def complete_row(row_number):
+                    progress.complete(row_number)
+                    if progress.last_processed_row - progress.saved_row >= CHECKPOINT_INTERVAL:
+                        writers.flush()
+                        save_checkpoint(progress.last_processed_row)
+                        progress.saved_row = progress.last_processed_row
+
+                async def run(row_number, address):
+                    try:
+                        row_number, address, withdraw_count, total_withdrawn = await process_address(client, cache, writers, row_number, address, always_fetch_events)
+                    finally:
+                        semaphore.release()
+
+                    # Writes are synchronous, so rows from concurrent addresses never interleave mid-row
+                    writers.write_summary({
+                        'address': address,
+                        'withdraw_count': withdraw_count,
+                        'sum_withdrawn_amount': total_withdrawn
+                    })
+                    complete_row(row_number)
+                    logging.info("Completed processing row %s, address: %s, Withdrawals: %s, Total amount: %s", row_number, address, withdraw_count, total_withdrawn)
+
+                start_row = progress.last_processed_row + 1
+                logging.info("Streaming addresses from %s, starting at row %s", INPUT_FILE, start_row)
+                # Rows are read one at a time. An address can have several vesting rows, so only
+                # the first row with a vesting is processed; already processed rows just seed `seen`.
+                reader = csv.DictReader(csvfile)
+                seen = {row['address'] for row in itertools.islice(reader, start_row) if has_vesting(row)}
+                # Rows after the checkpoint may have completed too, out of order or before a hard kill
+                seen |= writers.completed
+                # A failing address cancels the others and propagates once they have stopped
+                async with asyncio.TaskGroup() as tasks:
+                    for i, address_data in enumerate(reader, start=start_row):
+                        if not has_vesting(address_data) or address_data['address'] in seen:
+                            logging.debug("Skipping row %s, address: %s", i, address_data['address'])
+                            complete_row(i)
+                            continue
+                        seen.add(address_data['address'])
+
+                        # Wait for a free slot first, so only ADDRESS_CONCURRENCY rows are read ahead
+                        await semaphore.acquire()
+                        tasks.create_task(run(i, address_data['address']))
+    finally:
+        # Runs after the output files are closed, including on Ctrl-C and errors
+        if progress.last_processed_row != progress.saved_row:
+            save_checkpoint(progress.last_processed_row)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch reward withdrawals for every vested address")
+    parser.add_argument('--safe', action='store_true', help="write transactions through the csv module instead of the fast writer")
+    parser.add_argument('--always-fetch-events', action='store_true', help="fetch events for every transaction even when the transaction already carries the amount")
+    args = parser.parse_args()
+
     logging.info("Starting withdrawal processing")
-    process_all_addresses()
+    asyncio.run(process_all_addresses(safe=args.safe, always_fetch_events=args.always_fetch_events))
     logging.info("Withdrawal processing completed")
\ No newline at end of file